@@ -1,16 +1,64 @@
 from flask import request, Flask, send_file
 import time
-import os
 import cv2
 import pickle
 import numpy as np
 import evaluate
-import os
 import shutil
-from PIL import Image
+import sys
+import threading
+import queue
+import PIL
+from concurrent.futures import Future, TimeoutError
+
+try:
+    import xxhash
+
+    def hash_image(data):
+        return xxhash.xxh64(data).hexdigest()
+except ImportError:
+    import hashlib
+
+    def hash_image(data):
+        return hashlib.blake2b(data, digest_size=8).hexdigest()
 
 app = Flask(__name__)
 
+# Maximum time (in seconds) a request waits for its prediction.
+prediction_timeout = 60
+
+# Pillow-SIMD marks its releases with a post suffix, e.g. 6.0.0.post0
+if "post" not in PIL.__version__:
+    print("Pillow-SIMD is not installed, resizing the model input will be slower")
+
+# Load the model once at startup, instead of for every request. Only the first
+# checkpoint is used for the predictions, so the others are not loaded.
+# The command line options are only used when the app is run directly, not with a
+# server like gunicorn, which has its own.
+options = evaluate.parse_args(sys.argv[1:] if __name__ == "__main__" else [])
+model = evaluate.load_model(
+    options.checkpoint[0],
+    evaluate.get_device(options),
+    beam_width=options.beam_width,
+    batch_size=options.batch_size,
+)
+
+# All predictions are done on a single worker thread, which owns the model. The
+# request threads only put their images into the queue and wait for the result, which
+# allows the worker to decode concurrent requests together in one batch.
+images = queue.Queue()
+worker = threading.Thread(
+    target=evaluate.predict_queue,
+    args=(model, images),
+    kwargs={
+        "max_batch": options.batch_size,
+        "beam_width": options.beam_width,
+        "length_penalty": options.length_penalty,
+    },
+    daemon=True,
+)
+worker.start()
+
 @app.route('/')
 def index_page():
     return 'Hello, World!'
@@ -27,27 +75,26 @@ def upload_image():
         # im = Image.open(received_file)
         # im.resize((256,256),Image.ANTIALIAS)
 
-        received_dirPath = './data/test/2015'
-        imageFileName = received_file.filename
-        filepath = os.path.join(received_dirPath,imageFileName)
-
-        if os.path.isfile(filepath):
-            os.remove(filepath)
-            print(str(filepath) + "removed!")
-        
-        received_file.save(filepath)
-
+        # Decode straight from the uploaded bytes, which avoids writing the original
+        # image to disk only to read it back again.
         size = (256,256)
-        pri_image = Image.open(filepath)
-        pri_image.resize(size, Image.ANTIALIAS).save(filepath)
-        
-    
+        data = received_file.read()
+        pri_image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        pri_image = cv2.resize(pri_image, size, interpolation=cv2.INTER_AREA)
 
-        print('image file saved to %s' % filepath)
         usedTime = time.time() - startTime
-        print('接收图片并保存，总共耗时%.2f秒' % usedTime)
+        print('接收图片并缩放，总共耗时%.2f秒' % usedTime)
         startTime = time.time()
-        predict_latex = evaluate.main()
+        # The resized image is passed on directly, instead of saving it and decoding
+        # it once more.
+        future = Future()
+        # The hash of the uploaded file identifies the image for the encoder cache,
+        # e.g. when a request is retried.
+        images.put((future, evaluate.load_image(pri_image), hash_image(data)))
+        try:
+            predict_latex = future.result(timeout=prediction_timeout)
+        except TimeoutError:
+            return 'timeout', 504
 
 
         usedTime = time.time() - startTime
@@ -58,4 +105,4 @@ def upload_image():
         return 'failed'
     
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
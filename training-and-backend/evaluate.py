@@ -1,13 +1,27 @@
 import argparse
-import editdistance
 import os
+import queue
 import re
+import time
+import numpy as np
 import torch
+from collections import OrderedDict
+from dataclasses import dataclass
+from PIL import Image
+from rapidfuzz.distance import Levenshtein
 from torch.utils.data import DataLoader
 from torchvision import transforms
 from checkpoint import default_checkpoint, load_checkpoint
 from model import Encoder, Decoder
-from dataset import CrohmeDataset, START, PAD, SPECIAL_TOKENS, collate_batch
+from dataset import (
+    CrohmeDataset,
+    START,
+    END,
+    PAD,
+    SPECIAL_TOKENS,
+    collate_batch,
+    load_vocab,
+)
 
 input_size = (128, 128)
 low_res_shape = (684, input_size[0] // 16, input_size[1] // 16)
@@ -16,6 +30,15 @@ high_res_shape = (792, input_size[0] // 8, input_size[1] // 8)
 batch_size = 4
 num_workers = 4
 beam_width = 10
+# Maximum number of tokens generated for a single image, which has no ground truth to
+# determine the length.
+max_len = 200
+# Maximum memory (in bytes) of the encoded images that are cached when predicting
+# images from a queue. An image needs about 0.5MB in half precision.
+encoder_cache_size = 256 * 1024 * 1024
+# Finished hypotheses are scored by log_prob / length**length_penalty, otherwise the
+# beam search would strongly favour short sequences.
+length_penalty = 0.6
 
 test_sets = {
     "train": {"groundtruth": "./data/groundtruth_train.tsv", "root": "./data/train/"},
@@ -43,6 +66,9 @@ non_symbols = [
 tokensfile = "./data/tokens.tsv"
 use_cuda = torch.cuda.is_available()
 
+# Loaded models by checkpoint path and device, see load_model.
+models = {}
+
 transformers = transforms.Compose(
     [
         # Resize so all images have the same size
@@ -54,28 +80,30 @@ transformers = transforms.Compose(
 
 # strip_only means that only special tokens on the sides are removed. Equivalent to
 # String.strip()
-def remove_special_tokens(tokens, special_tokens=SPECIAL_TOKENS, strip_only=False):
+# special_tokens is a tensor of the token ids to remove, so that the removal is a single
+# torch.isin instead of checking every token in Python.
+def remove_special_tokens(tokens, special_tokens, strip_only=False):
     if strip_only:
+        special_tokens = set(special_tokens.tolist())
+        token_list = tokens.tolist()
         num_left = 0
         num_right = 0
-        for tok in tokens:
+        for tok in token_list:
             if tok not in special_tokens:
                 break
             num_left += 1
-        for tok in reversed(tokens):
+        for tok in reversed(token_list):
             if tok not in special_tokens:
                 break
             num_right += 1
-        return tokens[num_left:-num_right]
+        return tokens[num_left : len(token_list) - num_right]
     else:
-        return torch.tensor(
-            [tok for tok in tokens if tok not in special_tokens], dtype=tokens.dtype
-        )
+        return tokens[~torch.isin(tokens, special_tokens)]
 
 
 def calc_distances(actual, expected):
     return [
-        editdistance.eval(act.tolist(), exp.tolist())
+        Levenshtein.distance(act.tolist(), exp.tolist())
         for act, exp in zip(actual, expected)
     ]
 
@@ -207,24 +235,6 @@ def create_markdown_tables(results):
     return err_table, correct_table
 
 
-# Convert hypothesis batches to hypothesis grouped by sequence.
-def unbatch_hypotheses(hypotheses):
-    if not hypotheses:
-        return []
-    hypotheses_by_seq = [[] for _ in hypotheses[0]["probability"]]
-    for h in hypotheses:
-        for i in range(len(h["probability"])):
-            single_h = {
-                "sequence": {"full": h["sequence"]["full"][i]},
-                # The hidden weights have batch size in the second dimension, not first.
-                "hidden": h["hidden"][:, i],
-                "attn": {"low": h["attn"]["low"][i], "high": h["attn"]["high"][i]},
-                "probability": h["probability"][i],
-            }
-            hypotheses_by_seq[i].append(single_h)
-    return hypotheses_by_seq
-
-
 def batch_single_hypotheses(single_hypotheses):
     # It might be possible that the different sequences have a different number of total
     # hypotheses, since there might be duplicates in one of them. To prevent that take
@@ -234,18 +244,11 @@ def batch_single_hypotheses(single_hypotheses):
     batched_hypotheses = []
     for i in range(min_len):
         batch_h = {
+            # The sequences are not stacked, because they may have ended at different
+            # steps and therefore have different lengths. Instead it's a list of
+            # tensors.
             "sequence": {
-                "full": torch.stack(
-                    [hs[i]["sequence"]["full"] for hs in single_hypotheses]
-                )
-            },
-            # The hidden weights have batch size in the second dimension, not first.
-            "hidden": torch.stack([hs[i]["hidden"] for hs in single_hypotheses], dim=1),
-            "attn": {
-                "low": torch.stack([hs[i]["attn"]["low"] for hs in single_hypotheses]),
-                "high": torch.stack(
-                    [hs[i]["attn"]["high"] for hs in single_hypotheses]
-                ),
+                "full": [hs[i]["sequence"]["full"] for hs in single_hypotheses]
             },
             "probability": torch.stack(
                 [hs[i]["probability"] for hs in single_hypotheses]
@@ -256,44 +259,336 @@ def batch_single_hypotheses(single_hypotheses):
 
 
 # Picks the k sequences with the best probabilities. Each sequence is inspected
-# separately and at the end new hypotheses are created by stacking the k best ones of
-# each sequence to create batches, that can be used for the next step.
-def pick_top_k_unique(hypotheses, count):
-    sorted_hypotheses = [
-        sorted(hs, key=lambda h: h["probability"].item(), reverse=True)
-        for hs in unbatch_hypotheses(hypotheses)
-    ]
-    unique_hypotheses = [[] for _ in sorted_hypotheses]
+# separately (hypotheses grouped by sequence) and at the end new hypotheses are created
+# by batching the k best ones of each sequence.
+def pick_top_k_unique(hypotheses_by_seq, count):
+    unique_hypotheses = [[] for _ in hypotheses_by_seq]
 
-    for i, hs in enumerate(sorted_hypotheses):
-        for h in hs:
+    for i, hs in enumerate(hypotheses_by_seq):
+        # The probabilities are sorted on the device and only the order is copied to
+        # the CPU, instead of calling .item() on the probability of every hypothesis.
+        probabilities = torch.stack([h["probability"] for h in hs])
+        order = torch.argsort(probabilities, descending=True).tolist()
+        # Similarly, all sequences are copied at once and split up on the CPU.
+        sequences = [h["sequence"]["full"] for h in hs]
+        tokens = torch.cat(sequences).tolist()
+        offsets = [0]
+        for seq in sequences:
+            offsets.append(offsets[-1] + len(seq))
+        # The sequences are compared by their tokens as a tuple, which makes the lookup
+        # a hash set membership test instead of comparing it to every picked sequence.
+        seen = set()
+        for j in order:
             if len(unique_hypotheses[i]) >= count:
                 break
-            already_exists = False
-            for h_uniq in unique_hypotheses[i]:
-                already_exists = torch.equal(
-                    h["sequence"]["full"], h_uniq["sequence"]["full"]
-                )
-                if already_exists:
-                    break
-            if not already_exists:
-                unique_hypotheses[i].append(h)
+            key = tuple(tokens[offsets[j] : offsets[j + 1]])
+            if key not in seen:
+                seen.add(key)
+                unique_hypotheses[i].append(hs[j])
 
     return batch_single_hypotheses(unique_hypotheses)
 
 
+# Half precision on CUDA, which runs the convolutions and matrix multiplications of the
+# encoder and decoder on the tensor cores. The CPU keeps using single precision.
+def autocast(device):
+    return torch.autocast("cuda", dtype=torch.float16, enabled=device.type == "cuda")
+
+
+@dataclass
+class BeamState:
+    """
+    Hypotheses of the beam search in a structure of arrays. All of them have
+    batch_size * beam_width rows, where the beam_width rows of the first sequence come
+    first, then the ones of the second sequence etc.
+    """
+
+    # (batch_size * beam_width x seq_len)
+    sequence: torch.Tensor
+    # (1 x batch_size * beam_width x hidden_size)
+    # The hidden weights have batch size in the second dimension, not first.
+    hidden: torch.Tensor
+    # (batch_size * beam_width x seq_len x L)
+    attn_low: torch.Tensor
+    attn_high: torch.Tensor
+    # Log probabilities, which are added instead of multiplied and do not underflow
+    # for long sequences.
+    # (batch_size * beam_width)
+    probability: torch.Tensor
+
+
+# Decodes images with a beam search, while they are streamed in. All hypotheses are kept
+# in a single BeamState, so that each step only needs a single forward pass of the
+# decoder, instead of one per hypothesis. The best continuations of a sequence are
+# chosen jointly across all of its hypotheses, which means that they are already unique
+# and sorted by their probabilities (log-domain).
+#
+# Hypotheses ending with the END token are moved out of the beam. A sequence is done
+# once its best finished hypothesis scores at least as high as the best one still in
+# the beam, or when num_steps tokens have been generated. Done sequences are yielded as
+# (key, hypotheses) and their rows are removed from the state, so they do not waste any
+# decoder compute. The freed up slots are refilled by calling fetch(count), which
+# returns up to count encoded images as (keys, enc_low_res, enc_high_res), starting
+# them from the START token, while the other sequences continue where they are. The
+# stream ends when there are no sequences left and fetch does not return any new ones.
+@torch.inference_mode()
+def beam_search_stream(
+    dec,
+    fetch,
+    start_id,
+    end_id,
+    num_steps,
+    max_batch=batch_size,
+    beam_width=beam_width,
+    length_penalty=length_penalty,
+):
+    state = None
+    # Per sequence, i.e. image
+    keys = []
+    num_generated = []
+    # Finished hypotheses, with their length normalised scores.
+    finished = []
+    best_finished = []
+    while True:
+        if len(keys) < max_batch:
+            new_keys, new_low_res, new_high_res = fetch(max_batch - len(keys))
+            if new_keys:
+                device = new_low_res.device
+                num_rows = len(new_keys) * beam_width
+                # Sequences that are already in the beam have generated more tokens.
+                # The new ones are left padded with START tokens and zero attention,
+                # which does not change the sum of the coverage attention. The padding
+                # is never part of the result, as it's cut off by num_generated.
+                seq_len = 1 if state is None else state.sequence.size(1)
+                # Every sequence starts with beam_width identical hypotheses with
+                # a START token, but only the first one has a probability of 1
+                # (log(1) = 0), the others 0 (-inf). That way the first step only picks
+                # continuations of the first one, while the state has a fixed size.
+                probability = torch.full(
+                    (len(new_keys), beam_width), -float("inf"), device=device
+                )
+                probability[:, 0] = 0
+                new_state = BeamState(
+                    sequence=torch.full(
+                        (num_rows, seq_len), start_id, dtype=torch.long, device=device
+                    ),
+                    hidden=dec.init_hidden(num_rows).to(device),
+                    attn_low=torch.zeros(
+                        (num_rows, seq_len, dec.coverage_attn_low.attn_size),
+                        device=device,
+                    ),
+                    attn_high=torch.zeros(
+                        (num_rows, seq_len, dec.coverage_attn_high.attn_size),
+                        device=device,
+                    ),
+                    probability=probability.view(-1),
+                )
+                if state is None:
+                    state = new_state
+                    enc_low_res = new_low_res
+                    enc_high_res = new_high_res
+                else:
+                    state = BeamState(
+                        sequence=torch.cat((state.sequence, new_state.sequence)),
+                        hidden=torch.cat((state.hidden, new_state.hidden), dim=1),
+                        attn_low=torch.cat((state.attn_low, new_state.attn_low)),
+                        attn_high=torch.cat((state.attn_high, new_state.attn_high)),
+                        probability=torch.cat(
+                            (state.probability, new_state.probability)
+                        ),
+                    )
+                    enc_low_res = torch.cat((enc_low_res, new_low_res))
+                    enc_high_res = torch.cat((enc_high_res, new_high_res))
+                keys.extend(new_keys)
+                num_generated.extend([0 for _ in new_keys])
+                finished.extend([[] for _ in new_keys])
+                best_finished.extend([None for _ in new_keys])
+        if not keys:
+            return
+
+        curr_batch_size = len(keys)
+        with autocast(device):
+            out, next_hidden, next_attn_low, next_attn_high = dec(
+                state.sequence[:, -1:],
+                state.hidden,
+                enc_low_res,
+                enc_high_res,
+                state.attn_low,
+                state.attn_high,
+            )
+        # The output may be padded (see Decoder.pad_classes)
+        num_classes = dec.num_classes
+        # The probabilities are accumulated in single precision.
+        out = out[:, :num_classes].float()
+        # Twice the beam width, since every hypothesis can end with the END token, so
+        # there are always at least beam_width candidates that continue.
+        num_candidates = min(2 * beam_width, num_classes)
+        # The best candidates of a sequence can only be among the best ones of each of
+        # its hypotheses. The softmax does not change the order, so they are chosen
+        # from the logits, and only those are converted to log probabilities, instead
+        # of computing a log_softmax over all classes.
+        # log_softmax(x) = x - logsumexp(x)
+        row_logits, row_tokens = torch.topk(out, num_candidates)
+        log_probs = row_logits - torch.logsumexp(out, dim=1, keepdim=True)
+        log_probs = log_probs + state.probability.unsqueeze(1)
+        # Group the candidates by sequence
+        # From: (batch_size * beam_width x num_candidates)
+        # To: (batch_size x beam_width * num_candidates)
+        log_probs = log_probs.view(curr_batch_size, -1)
+        topk_probs, topk_ids = torch.topk(log_probs, num_candidates)
+        # The index in the joint space identifies the hypothesis that is continued
+        # and the token it is continued with.
+        batch_offsets = (
+            torch.arange(curr_batch_size, device=device).unsqueeze(1) * beam_width
+        )
+        topk_rows = topk_ids // num_candidates + batch_offsets
+        topk_tokens = row_tokens.view(curr_batch_size, -1).gather(1, topk_ids)
+        is_end = topk_tokens == end_id
+        # Seq len = num_generated, as the START token is not counted but the END token
+        # is.
+        num_generated = [n + 1 for n in num_generated]
+        normalisers = [n ** length_penalty for n in num_generated]
+
+        # Only the END candidates among the beam_width best are considered finished.
+        ended = is_end[:, :beam_width].nonzero().tolist()
+        if ended:
+            # Copied to the CPU at once, rather than one .item() per candidate.
+            scores_list = topk_probs[:, :beam_width].tolist()
+        for b, k in ended:
+            sequence = torch.cat(
+                (
+                    state.sequence[topk_rows[b, k], -num_generated[b] :],
+                    topk_tokens[b, k : k + 1],
+                )
+            )
+            score = scores_list[b][k] / normalisers[b]
+            finished[b].append(
+                {
+                    "sequence": {"full": sequence},
+                    "probability": topk_probs[b, k] / normalisers[b],
+                }
+            )
+            if best_finished[b] is None or score > best_finished[b]:
+                best_finished[b] = score
+
+        # The beam_width best candidates that did not end continue.
+        is_continued = ~is_end & ((~is_end).cumsum(dim=1) <= beam_width)
+        continued = is_continued.nonzero()[:, 1].view(curr_batch_size, beam_width)
+        topk_probs = topk_probs.gather(1, continued)
+        rows = topk_rows.gather(1, continued).view(-1)
+        tokens = topk_tokens.gather(1, continued).view(-1, 1)
+        state = BeamState(
+            sequence=torch.cat((state.sequence.index_select(0, rows), tokens), dim=1),
+            hidden=next_hidden.index_select(1, rows),
+            attn_low=next_attn_low.index_select(0, rows),
+            attn_high=next_attn_high.index_select(0, rows),
+            probability=topk_probs.view(-1),
+        )
+
+        best_active = topk_probs[:, 0].tolist()
+        kept = []
+        for b, best in enumerate(best_active):
+            is_done = num_generated[b] >= num_steps or (
+                best_finished[b] is not None
+                and best_finished[b] >= best / normalisers[b]
+            )
+            if not is_done:
+                kept.append(b)
+                continue
+            # Sequences that do not have enough finished hypotheses are filled up with
+            # the ones remaining in the beam.
+            if len(finished[b]) < beam_width:
+                finished[b].extend(
+                    [
+                        {
+                            "sequence": {
+                                "full": state.sequence[row, -num_generated[b] - 1 :]
+                            },
+                            "probability": state.probability[row] / normalisers[b],
+                        }
+                        for row in range(b * beam_width, (b + 1) * beam_width)
+                    ]
+                )
+            yield keys[b], finished[b]
+
+        if len(kept) < curr_batch_size:
+            # Remove the rows of the done sequences
+            rows = torch.tensor(
+                [b * beam_width + k for b in kept for k in range(beam_width)],
+                dtype=torch.long,
+                device=device,
+            )
+            # Padding that is no longer needed by any remaining sequence.
+            seq_len = max([num_generated[b] for b in kept], default=0) + 1
+            state = BeamState(
+                sequence=state.sequence.index_select(0, rows)[:, -seq_len:],
+                hidden=state.hidden.index_select(1, rows),
+                attn_low=state.attn_low.index_select(0, rows)[:, -seq_len:],
+                attn_high=state.attn_high.index_select(0, rows)[:, -seq_len:],
+                probability=state.probability.index_select(0, rows),
+            )
+            # The annotations are only kept once per sequence, as the decoder
+            # broadcasts them across the hypotheses.
+            kept_images = torch.tensor(kept, dtype=torch.long, device=device)
+            enc_low_res = enc_low_res.index_select(0, kept_images)
+            enc_high_res = enc_high_res.index_select(0, kept_images)
+            keys = [keys[b] for b in kept]
+            num_generated = [num_generated[b] for b in kept]
+            finished = [finished[b] for b in kept]
+            best_finished = [best_finished[b] for b in kept]
+            if not kept:
+                state = None
+
+
+# Decodes a batch of encoded images with the streaming beam search, where all images
+# start at once and the result is sorted like the batch.
+def beam_search(
+    dec,
+    enc_low_res,
+    enc_high_res,
+    start_id,
+    end_id,
+    num_steps,
+    beam_width=beam_width,
+    length_penalty=length_penalty,
+):
+    curr_batch_size = len(enc_low_res)
+    pending = [(list(range(curr_batch_size)), enc_low_res, enc_high_res)]
+
+    def fetch(count):
+        return pending.pop() if pending else ([], None, None)
+
+    finished = [None for _ in range(curr_batch_size)]
+    for i, hypotheses in beam_search_stream(
+        dec,
+        fetch,
+        start_id=start_id,
+        end_id=end_id,
+        num_steps=num_steps,
+        max_batch=curr_batch_size,
+        beam_width=beam_width,
+        length_penalty=length_penalty,
+    ):
+        finished[i] = hypotheses
+    return pick_top_k_unique(finished, beam_width)
+
+
+# Inference mode disables autograd entirely, including the version counters and view
+# tracking, which is cheaper than just disabling the gradients.
+@torch.inference_mode()
 def evaluate(
     enc,
     dec,
     data_loader,
     device,
+    special_tokens,
+    non_symbols_encoded,
     checkpoint=default_checkpoint,
     beam_width=beam_width,
+    length_penalty=length_penalty,
     prefix="",
 ):
     predict_latex = None
-    special_tokens = [data_loader.dataset.token_to_id[tok] for tok in SPECIAL_TOKENS]
-    non_symbols_encoded = [data_loader.dataset.token_to_id[tok] for tok in non_symbols]
     best = {
         "num_tokens": {"full": 0, "removed": 0, "symbols": 0},
         "distance": {"full": 0, "removed": 0, "symbols": 0},
@@ -312,72 +607,22 @@ def evaluate(
 
     for d in data_loader:
         input = d["image"].to(device)
-        # The last batch may not be a full batch
-        curr_batch_size = len(input)
         expected = d["truth"]["encoded"].to(device)
         batch_max_len = expected.size(1)
         # Replace -1 with the PAD token
         expected[expected == -1] = data_loader.dataset.token_to_id[PAD]
-        enc_low_res, enc_high_res = enc(input)
-        # Decoder needs to be reset, because the coverage attention (alpha)
-        # only applies to the current image.
-        dec.reset(curr_batch_size)
-        hidden = dec.init_hidden(curr_batch_size).to(device)
-        # Starts with a START token
-        sequence = torch.full(
-            (curr_batch_size, 1),
-            data_loader.dataset.token_to_id[START],
-            dtype=torch.long,
-            device=device,
+        with autocast(device):
+            enc_low_res, enc_high_res = enc(input)
+        hypotheses = beam_search(
+            dec,
+            enc_low_res,
+            enc_high_res,
+            start_id=data_loader.dataset.token_to_id[START],
+            end_id=data_loader.dataset.token_to_id[END],
+            num_steps=batch_max_len - 1,
+            beam_width=beam_width,
+            length_penalty=length_penalty,
         )
-        hypotheses = [
-            {
-                "sequence": {"full": sequence},
-                "hidden": hidden,
-                "attn": {
-                    "low": dec.coverage_attn_low.alpha,
-                    "high": dec.coverage_attn_high.alpha,
-                },
-                # This will be a tensor of probabilities (one for each batch), but at
-                # the beginning it can be 1.0 because it will be broadcast for the
-                # multiplication and it means the first tensor of probabilities will be
-                # kept as is.
-                "probability": 1.0,
-            }
-        ]
-        for i in range(batch_max_len - 1):
-            step_hypotheses = []
-            for hypothesis in hypotheses:
-                curr_sequence = hypothesis["sequence"]["full"]
-                previous = curr_sequence[:, -1].view(-1, 1)
-                curr_hidden = hypothesis["hidden"]
-                # Set the attention to the corresponding values, otherwise it would use
-                # the attention from another hypothesis.
-                dec.coverage_attn_low.alpha = hypothesis["attn"]["low"]
-                dec.coverage_attn_high.alpha = hypothesis["attn"]["high"]
-                out, next_hidden = dec(previous, curr_hidden, enc_low_res, enc_high_res)
-                probabilities = torch.softmax(out, dim=1)
-                topk_probs, topk_ids = torch.topk(probabilities, beam_width)
-                # topks are transposed, because the columns are needed, not the rows.
-                # One column is the top values for the batches, and there are k rows.
-                for top_prob, top_id in zip(topk_probs.t(), topk_ids.t()):
-                    next_sequence = torch.cat(
-                        (curr_sequence, top_id.view(-1, 1)), dim=1
-                    )
-                    probability = hypothesis["probability"] * top_prob
-                    next_hypothesis = {
-                        "sequence": {"full": next_sequence},
-                        "hidden": next_hidden,
-                        "attn": {
-                            "low": dec.coverage_attn_low.alpha,
-                            "high": dec.coverage_attn_high.alpha,
-                        },
-                        "probability": probability,
-                    }
-                    step_hypotheses.append(next_hypothesis)
-            # Only the beam_width number of hypotheses with the highest probabilities
-            # are kept for the next iteration.
-            hypotheses = pick_top_k_unique(step_hypotheses, beam_width)
 
         expected_removed = [
             remove_special_tokens(exp, special_tokens) for exp in expected
@@ -393,8 +638,19 @@ def evaluate(
             "removed": sum([exp.numel() for exp in expected_removed]),
             "symbols": sum([exp.numel() for exp in expected_symbols]),
         }
+        pad_id = data_loader.dataset.token_to_id[PAD]
         for hypothesis in hypotheses:
             sequence = hypothesis["sequence"]
+            # The beam search stops at the END token, but the expected sequences are
+            # padded to the longest one in the batch, and the model is trained to
+            # predict PAD after END. Padding the hypotheses the same way keeps the
+            # full statistics comparable.
+            sequence["full"] = [
+                torch.nn.functional.pad(
+                    seq, (0, batch_max_len - seq.size(0)), value=pad_id
+                )
+                for seq in sequence["full"]
+            ]
             sequence["removed"] = [
                 remove_special_tokens(seq, special_tokens) for seq in sequence["full"]
             ]
@@ -503,7 +759,7 @@ def evaluate(
     return {"best": best, "mean": mean, "highest_prob": highest_prob},predict_latex
 
 
-def parse_args():
+def parse_args(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-c",
@@ -547,6 +803,16 @@ def parse_args():
         type=int,
         help="Width of the beam [default: {}]".format(beam_width),
     )
+    parser.add_argument(
+        "--length-penalty",
+        dest="length_penalty",
+        default=length_penalty,
+        type=float,
+        help=(
+            "Exponent of the length normalisation of finished hypotheses "
+            "[default: {}]"
+        ).format(length_penalty),
+    )
     parser.add_argument(
         "--no-cuda",
         dest="no_cuda",
@@ -561,27 +827,297 @@ def parse_args():
         help="Prefix of checkpoint names",
     )
 
-    return parser.parse_args()
+    return parser.parse_args(args)
 
 
-def main():
-    options = parse_args()
+# Creates the encoder and decoder of a checkpoint together with the encoded special
+# tokens. They are only created once per checkpoint and device and are reused for all
+# subsequent evaluations, since loading them takes much longer than evaluating a single
+# image, e.g. in the server where every request is evaluated separately.
+# The beam width and batch size are only used to compile the models for the shapes
+# they will be used with.
+def load_model(checkpoint_path, device, beam_width=beam_width, batch_size=batch_size):
+    key = (checkpoint_path, str(device))
+    if key not in models:
+        checkpoint = (
+            load_checkpoint(checkpoint_path, cuda=device.type == "cuda")
+            if checkpoint_path
+            else default_checkpoint
+        )
+        encoder_checkpoint = checkpoint["model"].get("encoder")
+        decoder_checkpoint = checkpoint["model"].get("decoder")
+        token_to_id, id_to_token = load_vocab(tokensfile)
+
+        enc = Encoder(img_channels=3, checkpoint=encoder_checkpoint).to(device)
+        dec = Decoder(
+            len(id_to_token),
+            low_res_shape,
+            high_res_shape,
+            checkpoint=decoder_checkpoint,
+            device=device,
+        ).to(device)
+        enc.eval()
+        dec.eval()
+        if device.type == "cuda":
+            dec.pad_classes(8)
+        # Fusing the many small kernels of each decoder step reduces the launch
+        # overhead. CUDA graphs (reduce-overhead) are not used, because the inputs of
+        # the decoder change their shape in every step (the attention grows by one,
+        # and sequences join and leave the beam search), which would record a new
+        # graph for each of them.
+        if hasattr(torch, "compile") and device.type == "cuda":
+            enc = torch.compile(enc)
+            dec = torch.compile(dec)
+            # The compilation happens on the first calls, so a batch of blank images is
+            # decoded once, rather than delaying the first evaluation. The second step
+            # recompiles the decoder with a dynamic attention length, which is then
+            # used for all other steps.
+            with torch.inference_mode(), autocast(device):
+                enc_low_res, enc_high_res = enc(
+                    torch.zeros((batch_size, 3, *input_size), device=device)
+                )
+            beam_search(
+                dec,
+                enc_low_res,
+                enc_high_res,
+                start_id=token_to_id[START],
+                end_id=token_to_id[END],
+                num_steps=2,
+                beam_width=beam_width,
+            )
+        else:
+            # Without torch.compile (PyTorch < 2.0) or on the CPU, TorchScript still
+            # removes the Python overhead of the decoder, which runs once per step.
+            dec = torch.jit.script(dec)
+
+        models[key] = {
+            "checkpoint": checkpoint,
+            "encoder": enc,
+            "decoder": dec,
+            "device": device,
+            "token_to_id": token_to_id,
+            "id_to_token": id_to_token,
+            "special_tokens": torch.tensor(
+                [token_to_id[tok] for tok in SPECIAL_TOKENS], device=device
+            ),
+            "non_symbols": torch.tensor(
+                [token_to_id[tok] for tok in non_symbols], device=device
+            ),
+        }
+    return models[key]
+
+
+def get_device(options):
     is_cuda = use_cuda and not options.no_cuda
     hardware = "cuda" if is_cuda else "cpu"
-    device = torch.device(hardware)
+    return torch.device(hardware)
+
+
+def load_models(options):
+    device = get_device(options)
+    return [
+        load_model(
+            checkpoint_path,
+            device,
+            beam_width=options.beam_width,
+            batch_size=options.batch_size,
+        )
+        for checkpoint_path in options.checkpoint
+    ]
+
+
+# Converts a single image to the input of the encoder. The image can be given as a path,
+# a PIL image or an array as returned by OpenCV, i.e. with the channels in BGR order.
+def load_image(image):
+    if isinstance(image, str):
+        image = Image.open(image)
+    elif isinstance(image, np.ndarray):
+        if image.ndim == 3:
+            # BGR to RGB
+            image = np.ascontiguousarray(image[:, :, ::-1])
+        image = Image.fromarray(image)
+    # Remove alpha channel
+    image = image.convert("RGB")
+    # Add the batch dimension, it's a batch with a single image.
+    return transformers(image).unsqueeze(0)
+
+
+# Predicts the LaTeX string of a single image with the hypothesis that has the highest
+# probability.
+@torch.inference_mode()
+def predict(model, image, beam_width=beam_width, length_penalty=length_penalty):
+    device = model["device"]
+    token_to_id = model["token_to_id"]
+    input = load_image(image).to(device)
+    with autocast(device):
+        enc_low_res, enc_high_res = model["encoder"](input)
+    hypotheses = beam_search(
+        model["decoder"],
+        enc_low_res,
+        enc_high_res,
+        start_id=token_to_id[START],
+        end_id=token_to_id[END],
+        num_steps=max_len,
+        beam_width=beam_width,
+        length_penalty=length_penalty,
+    )
+    return sequence_to_latex(model, hypotheses[0]["sequence"]["full"][0])
+
+
+# Converts the tokens of a sequence to a LaTeX string, without the special tokens.
+def sequence_to_latex(model, sequence):
+    removed = remove_special_tokens(sequence, model["special_tokens"])
+    return "".join([model["id_to_token"][i] for i in removed.tolist()])
+
+
+# Least recently used cache of the encoded images, which is limited by the memory of the
+# cached tensors rather than the number of images.
+class EncoderCache:
+    def __init__(self, max_size=encoder_cache_size):
+        """
+        Args:
+            max_size (int, optional): Maximum memory of the cached tensors in bytes
+                [Default: encoder_cache_size]
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        if key in self.entries:
+            return
+        self.entries[key] = entry
+        self.size += sum([t.numel() * t.element_size() for t in entry])
+        while self.size > self.max_size:
+            _, removed = self.entries.popitem(last=False)
+            self.size -= sum([t.numel() * t.element_size() for t in removed])
+
+
+# Predicts the images of a queue, which contains (future, input, key) tuples, where the
+# input is created by load_image. The LaTeX string is set as the result of the future.
+#
+# The key identifies the image (e.g. a hash of the file), so that the encoder can be
+# skipped for images that have been predicted before, such as retried requests. Images
+# without a key (None) are not cached. The cache belongs to the model and is discarded
+# along with it.
+#
+# It never returns and is meant to run on a dedicated thread, which is the only one
+# using the model. All images are decoded together by the streaming beam search, so
+# images that arrive while others are being decoded join them at the next step. When
+# it's idle, it waits for the first image and then batch_timeout seconds (10ms) for
+# more, so that simultaneous requests start as one batch.
+@torch.inference_mode()
+def predict_queue(
+    model,
+    images,
+    max_batch=batch_size,
+    batch_timeout=0.01,
+    beam_width=beam_width,
+    length_penalty=length_penalty,
+    cache_size=encoder_cache_size,
+):
+    device = model["device"]
+    token_to_id = model["token_to_id"]
+    cache = EncoderCache(cache_size)
+    # Futures whose images are currently in the beam search.
+    in_flight = set()
+
+    def fetch(count):
+        items = []
+        # Nothing is being decoded, otherwise count would be lower than max_batch.
+        if count == max_batch:
+            items.append(images.get())
+            deadline = time.monotonic() + batch_timeout
+        else:
+            deadline = time.monotonic()
+        while len(items) < count:
+            try:
+                items.append(images.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        if not items:
+            return [], None, None
+        in_flight.update([future for future, _, _ in items])
+        encoded = [cache.get(key) if key is not None else None for _, _, key in items]
+        missing = [i for i, enc in enumerate(encoded) if enc is None]
+        if missing:
+            inputs = torch.cat([items[i][1] for i in missing]).to(device)
+            with autocast(device):
+                enc_low_res, enc_high_res = model["encoder"](inputs)
+            for j, i in enumerate(missing):
+                encoded[i] = (enc_low_res[j : j + 1], enc_high_res[j : j + 1])
+                key = items[i][2]
+                if key is not None:
+                    # Cloned, otherwise the slices would keep the whole batch in memory.
+                    encoded[i] = tuple([enc.clone() for enc in encoded[i]])
+                    cache.put(key, encoded[i])
+        futures = [future for future, _, _ in items]
+        enc_low_res = torch.cat([low_res for low_res, _ in encoded])
+        enc_high_res = torch.cat([high_res for _, high_res in encoded])
+        return futures, enc_low_res, enc_high_res
+
+    while True:
+        try:
+            for future, hypotheses in beam_search_stream(
+                model["decoder"],
+                fetch,
+                start_id=token_to_id[START],
+                end_id=token_to_id[END],
+                num_steps=max_len,
+                max_batch=max_batch,
+                beam_width=beam_width,
+                length_penalty=length_penalty,
+            ):
+                try:
+                    best = pick_top_k_unique([hypotheses], 1)[0]
+                    latex = sequence_to_latex(model, best["sequence"]["full"][0])
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(latex)
+                # Only removed once the future has a result, so that it is never left
+                # without one when anything fails.
+                in_flight.discard(future)
+        except Exception as e:
+            # The images in the failed beam search are lost, but the following ones
+            # can still be predicted.
+            for future in in_flight:
+                future.set_exception(e)
+            in_flight.clear()
+
+
+# Without an image, the checkpoints are evaluated on the datasets. Otherwise only the
+# given image is predicted with the first checkpoint, see load_image for the supported
+# types of images.
+# The options are parsed from args, a list of command line arguments, which defaults to
+# sys.argv.
+def main(image=None, args=None):
+    options = parse_args(args)
+
+    if image is not None:
+        model = load_model(
+            options.checkpoint[0],
+            get_device(options),
+            beam_width=options.beam_width,
+            batch_size=options.batch_size,
+        )
+        return predict(
+            model,
+            image,
+            beam_width=options.beam_width,
+            length_penalty=options.length_penalty,
+        )
 
     for dataset_name in options.dataset:
         results = {"best": {}, "mean": {}, "highest_prob": {}}
-        for checkpoint_path in options.checkpoint:
+        for checkpoint_path, model in zip(options.checkpoint, load_models(options)):
             checkpoint_name, _ = os.path.splitext(os.path.basename(checkpoint_path))
-            checkpoint = (
-                load_checkpoint(checkpoint_path, cuda=is_cuda)
-                if checkpoint_path
-                else default_checkpoint
-            )
-            encoder_checkpoint = checkpoint["model"].get("encoder")
-            decoder_checkpoint = checkpoint["model"].get("decoder")
-
             test_set = test_sets[dataset_name]
             dataset = CrohmeDataset(
                 test_set["groundtruth"],
@@ -597,24 +1133,16 @@ def main():
                 collate_fn=collate_batch,
             )
 
-            enc = Encoder(img_channels=3, checkpoint=encoder_checkpoint).to(device)
-            dec = Decoder(
-                len(dataset.id_to_token),
-                low_res_shape,
-                high_res_shape,
-                checkpoint=decoder_checkpoint,
-                device=device,
-            ).to(device)
-            enc.eval()
-            dec.eval()
-
-            result,predict_latex = evaluate(
-                enc,
-                dec,
+            result, predict_latex = evaluate(
+                model["encoder"],
+                model["decoder"],
                 data_loader=data_loader,
-                device=device,
-                checkpoint=checkpoint,
+                device=model["device"],
+                special_tokens=model["special_tokens"],
+                non_symbols_encoded=model["non_symbols"],
+                checkpoint=model["checkpoint"],
                 beam_width=options.beam_width,
+                length_penalty=options.length_penalty,
                 prefix=options.prefix,
             )
             results["best"][checkpoint_name] = result["best"]
@@ -225,7 +225,6 @@ class CoverageAttention(nn.Module):
             device (torch.device, optional): Device for the tensors
         """
         super(CoverageAttention, self).__init__()
-        self.alpha = None
         self.conv = nn.Conv2d(1, output_size, kernel_size=kernel_size, padding=padding)
         self.U_a = nn.Parameter(torch.empty((n_prime, input_size)))
         self.U_f = nn.Parameter(torch.empty((n_prime, output_size)))
@@ -239,42 +238,61 @@ class CoverageAttention(nn.Module):
         # Xavier requires at least a 2D tensor.
         nn.init.xavier_normal_(self.nu_attn.unsqueeze(0))
 
-    def reset_alpha(self, batch_size):
-        self.alpha = torch.zeros((batch_size, 1, self.attn_size), device=self.device)
-
-    def forward(self, x, u_pred):
-        batch_size = x.size(0)
-        if self.alpha is None:
-            self.reset_alpha(batch_size)
+    @torch.jit.export
+    def init_alpha(self, batch_size: int):
+        return torch.zeros((batch_size, 1, self.attn_size), device=self.device)
+
+    # The previous attention vectors (alpha) are given and returned together with the
+    # new one, rather than being kept in the module, since they are specific to each
+    # sequence. That keeps the forward pass free of state.
+    #
+    # x may contain fewer images than there are sequences in u_pred and alpha, when
+    # multiple sequences attend to the same image (e.g. the hypotheses of a beam
+    # search). The sequences of an image need to be consecutive, and the annotations are
+    # broadcast across them, instead of being copied for every sequence.
+    def forward(self, x, u_pred, alpha):
+        batch_size = alpha.size(0)
+        num_images = x.size(0)
+        num_per_image = batch_size // num_images
         # Change the dimensions to make it possible to apply a 2D convolution
         # From: (batch_size x L)
         # To: (batch_size x H x W)
-        alpha_sum = self.alpha.sum(1).view(batch_size, x.size(2), x.size(3))
+        alpha_sum = alpha.sum(1).view(batch_size, x.size(2), x.size(3))
         conv_out = self.conv(alpha_sum.unsqueeze(1))
         # Change dimensions back
         # From: (batch_size x output_size x H x W)
         # To: (batch_size x output_size x L)
         conv_out = conv_out.view(batch_size, self.output_size, -1)
         # Change the dimensions
-        # From: (batch_size x C x H x W)
-        # To: (batch_size x C x L)
-        a = x.view(batch_size, x.size(1), -1)
+        # From: (num_images x C x H x W)
+        # To: (num_images x C x L)
+        a = x.view(num_images, x.size(1), -1)
         u_a = torch.matmul(self.U_a, a)
         u_f = torch.matmul(self.U_f, conv_out)
+        # The sequences are grouped by image, so that u_a is added to all sequences of
+        # the image without materialising it for each of them.
+        # u_a: (num_images x 1 x n_prime x L)
+        # u_f: (num_images x num_per_image x n_prime x L)
         # u_pred is expanded from (batch_size x n_prime)
-        # to (batch_size x n_prime x L) because there are L components to which
-        # the same u_pred is added.
-        u_pred_expanded = u_pred.unsqueeze(2).expand_as(u_a)
+        # to (num_images x num_per_image x n_prime x 1) because there are L components
+        # to which the same u_pred is added.
+        u_a = u_a.unsqueeze(1)
+        u_f = u_f.view(num_images, num_per_image, u_f.size(1), -1)
+        u_pred_expanded = u_pred.view(num_images, num_per_image, -1, 1)
         tan_res = torch.tanh(u_pred_expanded + u_a + u_f)
+        tan_res = tan_res.view(batch_size, tan_res.size(2), -1)
         e_t = torch.matmul(self.nu_attn, tan_res)
         alpha_t = torch.softmax(e_t, dim=1)
-        self.alpha = torch.cat((self.alpha, alpha_t.detach().unsqueeze(1)), dim=1)
+        alpha = torch.cat((alpha, alpha_t.detach().unsqueeze(1)), dim=1)
         # alpha_t: (batch_size x L)
-        # a: (batch_size x C x L) but need (C x batch_size x L) for
-        # element-wise multiplication. So transpose them.
-        cA_t_L = alpha_t * a.transpose(0, 1)
-        # Transpose back
-        return cA_t_L.transpose(0, 1).sum(2)
+        # a: (num_images x C x L)
+        # The context is the weighted sum of the annotations, which is a batched
+        # matrix multiplication per image:
+        # (num_images x num_per_image x L) x (num_images x L x C)
+        context = torch.bmm(
+            alpha_t.view(num_images, num_per_image, -1), a.transpose(1, 2)
+        )
+        return context.view(batch_size, -1), alpha
 
 
 class Maxout(nn.Module):
@@ -292,8 +310,11 @@ class Maxout(nn.Module):
         self.pool_size = pool_size
 
     def forward(self, x):
-        [*shape, last] = x.size()
-        out = x.view(*shape, last // self.pool_size, self.pool_size)
+        # The last dimension is split into (last / pool_size x pool_size)
+        shape = list(x.size())
+        shape[-1] = shape[-1] // self.pool_size
+        shape.append(self.pool_size)
+        out = x.view(shape)
         out, _ = out.max(-1)
         return out
 
@@ -363,6 +384,7 @@ class Decoder(nn.Module):
         self.U_pred = nn.Parameter(torch.empty((n_prime, n)))
         self.maxout = Maxout(2)
         self.hidden_size = hidden_size
+        self.num_classes = num_classes
         nn.init.xavier_normal_(self.W_o)
         nn.init.xavier_normal_(self.W_s)
         nn.init.xavier_normal_(self.W_c)
@@ -371,27 +393,43 @@ class Decoder(nn.Module):
         if checkpoint is not None:
             self.load_state_dict(checkpoint)
 
-    def init_hidden(self, batch_size):
+    @torch.jit.export
+    def init_hidden(self, batch_size: int):
         return torch.zeros((1, batch_size, self.hidden_size))
 
-    def reset(self, batch_size):
-        self.coverage_attn_low.reset_alpha(batch_size)
-        self.coverage_attn_high.reset_alpha(batch_size)
+    # Pads the output projection with zeros, such that the number of outputs is
+    # a multiple of the given number. FP16 matrix multiplications only run on the
+    # tensor cores if all dimensions are multiples of 8. The outputs beyond
+    # num_classes are meaningless and need to be discarded.
+    def pad_classes(self, multiple=8):
+        padded_size = (self.num_classes + multiple - 1) // multiple * multiple
+        W_o = self.W_o.new_zeros((padded_size, self.W_o.size(1)))
+        W_o[: self.num_classes] = self.W_o.detach()
+        self.W_o = nn.Parameter(W_o)
+
+    # The coverage attention (alpha) only applies to the current image, so it needs to
+    # be initialised for every batch.
+    @torch.jit.export
+    def init_alpha(self, batch_size: int):
+        return (
+            self.coverage_attn_low.init_alpha(batch_size),
+            self.coverage_attn_high.init_alpha(batch_size),
+        )
 
     # Unsqueeze and squeeze are used to add and remove the seq_len dimension,
     # which is always 1 since only the previous symbol is provided, not a sequence.
     # The inputs that are multiplied by the weights are transposed to get
     # (m x batch_size) instead of (batch_size x m). The result of the
     # multiplication is tranposed back.
-    def forward(self, x, hidden, low_res, high_res):
+    def forward(self, x, hidden, low_res, high_res, alpha_low, alpha_high):
         embedded = self.embedding(x)
         pred, _ = self.gru1(embedded, hidden)
         # u_pred is computed here instead of in the coverage attention, because the
         # weight U_pred is shared and the coverage attention does not use pred for
         # anything else. This avoids computing it twice.
         u_pred = torch.matmul(self.U_pred, pred.squeeze(1).t()).t()
-        context_low = self.coverage_attn_low(low_res, u_pred)
-        context_high = self.coverage_attn_high(high_res, u_pred)
+        context_low, alpha_low = self.coverage_attn_low(low_res, u_pred, alpha_low)
+        context_high, alpha_high = self.coverage_attn_high(high_res, u_pred, alpha_high)
         context = torch.cat((context_low, context_high), dim=1)
         new_hidden, _ = self.gru2(context.unsqueeze(1), pred.transpose(0, 1))
         w_s = torch.matmul(self.W_s, new_hidden.squeeze(1).t()).t()
@@ -399,4 +437,4 @@ class Decoder(nn.Module):
         out = embedded.squeeze(1) + w_s + w_c
         out = self.maxout(out)
         out = torch.matmul(self.W_o, out.t()).t()
-        return out, new_hidden.transpose(0, 1)
+        return out, new_hidden.transpose(0, 1), alpha_low, alpha_high
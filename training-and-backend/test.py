@@ -1,13 +1,11 @@
 import argparse
-import editdistance
-import os
 import re
 import torch
-from torch.utils.data import DataLoader
+from rapidfuzz.distance import Levenshtein
 from torchvision import transforms
-from checkpoint import default_checkpoint, load_checkpoint
-from model import Encoder, Decoder
-from dataset import CrohmeDataset, START, PAD, SPECIAL_TOKENS, collate_batch
+from checkpoint import default_checkpoint
+from dataset import CrohmeDataset, START, END, PAD, collate_batch
+from evaluate import autocast, beam_search, load_model, remove_special_tokens
 from PIL import Image, ImageOps
 
 input_size = (128, 128)
@@ -17,6 +15,8 @@ high_res_shape = (792, input_size[0] // 8, input_size[1] // 8)
 batch_size = 4
 num_workers = 4
 beam_width = 10
+# Maximum number of decoding steps, unless all hypotheses end before that.
+max_len = 200
 
 test_sets = {
     "train": {"groundtruth": "./data/groundtruth_train.tsv", "root": "./data/train/"},
@@ -52,30 +52,9 @@ transformers = transforms.Compose(
 )
 
 
-# strip_only means that only special tokens on the sides are removed. Equivalent to
-# String.strip()
-def remove_special_tokens(tokens, special_tokens=SPECIAL_TOKENS, strip_only=False):
-    if strip_only:
-        num_left = 0
-        num_right = 0
-        for tok in tokens:
-            if tok not in special_tokens:
-                break
-            num_left += 1
-        for tok in reversed(tokens):
-            if tok not in special_tokens:
-                break
-            num_right += 1
-        return tokens[num_left:-num_right]
-    else:
-        return torch.tensor(
-            [tok for tok in tokens if tok not in special_tokens], dtype=tokens.dtype
-        )
-
-
 def calc_distances(actual, expected):
     return [
-        editdistance.eval(act.tolist(), exp.tolist())
+        Levenshtein.distance(act.tolist(), exp.tolist())
         for act, exp in zip(actual, expected)
     ]
 
@@ -207,81 +186,6 @@ def create_markdown_tables(results):
     return err_table, correct_table
 
 
-# Convert hypothesis batches to hypothesis grouped by sequence.
-def unbatch_hypotheses(hypotheses):
-    if not hypotheses:
-        return []
-    hypotheses_by_seq = [[] for _ in hypotheses[0]["probability"]]
-    for h in hypotheses:
-        for i in range(len(h["probability"])):
-            single_h = {
-                "sequence": {"full": h["sequence"]["full"][i]},
-                # The hidden weights have batch size in the second dimension, not first.
-                "hidden": h["hidden"][:, i],
-                "attn": {"low": h["attn"]["low"][i], "high": h["attn"]["high"][i]},
-                "probability": h["probability"][i],
-            }
-            hypotheses_by_seq[i].append(single_h)
-    return hypotheses_by_seq
-
-
-def batch_single_hypotheses(single_hypotheses):
-    # It might be possible that the different sequences have a different number of total
-    # hypotheses, since there might be duplicates in one of them. To prevent that take
-    # the lowest number that is available. It might be smaller than the beam width.
-    # But there can only be batches where each sequence is present.
-    min_len = min(len(hs) for hs in single_hypotheses)
-    batched_hypotheses = []
-    for i in range(min_len):
-        batch_h = {
-            "sequence": {
-                "full": torch.stack(
-                    [hs[i]["sequence"]["full"] for hs in single_hypotheses]
-                )
-            },
-            # The hidden weights have batch size in the second dimension, not first.
-            "hidden": torch.stack([hs[i]["hidden"] for hs in single_hypotheses], dim=1),
-            "attn": {
-                "low": torch.stack([hs[i]["attn"]["low"] for hs in single_hypotheses]),
-                "high": torch.stack(
-                    [hs[i]["attn"]["high"] for hs in single_hypotheses]
-                ),
-            },
-            "probability": torch.stack(
-                [hs[i]["probability"] for hs in single_hypotheses]
-            ),
-        }
-        batched_hypotheses.append(batch_h)
-    return batched_hypotheses
-
-
-# Picks the k sequences with the best probabilities. Each sequence is inspected
-# separately and at the end new hypotheses are created by stacking the k best ones of
-# each sequence to create batches, that can be used for the next step.
-def pick_top_k_unique(hypotheses, count):
-    sorted_hypotheses = [
-        sorted(hs, key=lambda h: h["probability"].item(), reverse=True)
-        for hs in unbatch_hypotheses(hypotheses)
-    ]
-    unique_hypotheses = [[] for _ in sorted_hypotheses]
-
-    for i, hs in enumerate(sorted_hypotheses):
-        for h in hs:
-            if len(unique_hypotheses[i]) >= count:
-                break
-            already_exists = False
-            for h_uniq in unique_hypotheses[i]:
-                already_exists = torch.equal(
-                    h["sequence"]["full"], h_uniq["sequence"]["full"]
-                )
-                if already_exists:
-                    break
-            if not already_exists:
-                unique_hypotheses[i].append(h)
-
-    return batch_single_hypotheses(unique_hypotheses)
-
-
 # def evaluate(
 #     enc,
 #     dec,
@@ -384,89 +288,41 @@ def pick_top_k_unique(hypotheses, count):
 
 
 
+# Inference mode disables autograd entirely, including the version counters and view
+# tracking, which is cheaper than just disabling the gradients.
+@torch.inference_mode()
 def evaluate(
     enc,
     dec,
     test_img,
     # data_loader,
     device,
+    start_id,
+    end_id,
+    special_tokens,
+    non_symbols_encoded,
     checkpoint=default_checkpoint,
     beam_width=beam_width,
     prefix="",
 ):
-    data_loader = DataLoader()
-    special_tokens = [data_loader.dataset.token_to_id[tok] for tok in SPECIAL_TOKENS]
-    non_symbols_encoded = [data_loader.dataset.token_to_id[tok] for tok in non_symbols]
-    
 
     input = test_img.to(device)
-    # The last batch may not be a full batch
-    curr_batch_size = len(input)
 
     # expected = d["truth"]["encoded"].to(device)
     # batch_max_len = expected.size(1)
     # Replace -1 with the PAD token
     # expected[expected == -1] = data_loader.dataset.token_to_id[PAD]
-    enc_low_res, enc_high_res = enc(input)
-    # Decoder needs to be reset, because the coverage attention (alpha)
-    # only applies to the current image.
-    dec.reset(curr_batch_size)
-    hidden = dec.init_hidden(curr_batch_size).to(device)
-    # Starts with a START token
-    sequence = torch.full(
-        (curr_batch_size, 1),
-        data_loader.dataset.token_to_id[START],
-        dtype=torch.long,
-        device=device,
+    with autocast(device):
+        enc_low_res, enc_high_res = enc(input)
+    hypotheses = beam_search(
+        dec,
+        enc_low_res,
+        enc_high_res,
+        start_id=start_id,
+        end_id=end_id,
+        num_steps=max_len,
+        beam_width=beam_width,
     )
-    hypotheses = [
-        {
-            "sequence": {"full": sequence},
-            "hidden": hidden,
-            "attn": {
-                "low": dec.coverage_attn_low.alpha,
-                "high": dec.coverage_attn_high.alpha,
-            },
-            # This will be a tensor of probabilities (one for each batch), but at
-            # the beginning it can be 1.0 because it will be broadcast for the
-            # multiplication and it means the first tensor of probabilities will be
-            # kept as is.
-            "probability": 1.0,
-        }
-    ]
-    # for i in range(batch_max_len - 1):
-    step_hypotheses = []
-    for hypothesis in hypotheses:
-        curr_sequence = hypothesis["sequence"]["full"]
-        previous = curr_sequence[:, -1].view(-1, 1)
-        curr_hidden = hypothesis["hidden"]
-        # Set the attention to the corresponding values, otherwise it would use
-        # the attention from another hypothesis.
-        dec.coverage_attn_low.alpha = hypothesis["attn"]["low"]
-        dec.coverage_attn_high.alpha = hypothesis["attn"]["high"]
-        out, next_hidden = dec(previous, curr_hidden, enc_low_res, enc_high_res)
-        probabilities = torch.softmax(out, dim=1)
-        topk_probs, topk_ids = torch.topk(probabilities, beam_width)
-        # topks are transposed, because the columns are needed, not the rows.
-        # One column is the top values for the batches, and there are k rows.
-        for top_prob, top_id in zip(topk_probs.t(), topk_ids.t()):
-            next_sequence = torch.cat(
-                (curr_sequence, top_id.view(-1, 1)), dim=1
-            )
-            probability = hypothesis["probability"] * top_prob
-            next_hypothesis = {
-                "sequence": {"full": next_sequence},
-                "hidden": next_hidden,
-                "attn": {
-                    "low": dec.coverage_attn_low.alpha,
-                    "high": dec.coverage_attn_high.alpha,
-                },
-                "probability": probability,
-            }
-            step_hypotheses.append(next_hypothesis)
-    # Only the beam_width number of hypotheses with the highest probabilities
-    # are kept for the next iteration.
-    hypotheses = pick_top_k_unique(step_hypotheses, beam_width)
 
     # expected_removed = [
     #     remove_special_tokens(exp, special_tokens) for exp in expected
@@ -614,43 +470,28 @@ def main(test_img_path):
     hardware = "cuda" if is_cuda else "cpu"
     device = torch.device(hardware)
 
-    
-    for checkpoint_path in options.checkpoint:
-        checkpoint_name, _ = os.path.splitext(os.path.basename(checkpoint_path))
-        checkpoint = (
-            load_checkpoint(checkpoint_path, cuda=is_cuda)
-            if checkpoint_path
-            else default_checkpoint
-        )
-        encoder_checkpoint = checkpoint["model"].get("encoder")
-        decoder_checkpoint = checkpoint["model"].get("decoder")
-
-        test_img = Image.open(test_img_path)
-        test_img = test_img.convert("RGB")
-
-        enc = Encoder(img_channels=3, checkpoint=encoder_checkpoint).to(device)
-        dec = Decoder(
-            1,
-            low_res_shape,
-            high_res_shape,
-            checkpoint=decoder_checkpoint,
-            device=device,
-        ).to(device)
-        enc.eval()
-        dec.eval()
+    test_img = Image.open(test_img_path)
+    test_img = test_img.convert("RGB")
+    # Add the batch dimension, it's a batch with a single image.
+    test_img = transformers(test_img).unsqueeze(0)
 
+    for checkpoint_path in options.checkpoint:
+        model = load_model(checkpoint_path, device)
         result = evaluate(
-            enc,
-            dec,
+            model["encoder"],
+            model["decoder"],
             test_img=test_img,
             device=device,
-            checkpoint=checkpoint,
+            start_id=model["token_to_id"][START],
+            end_id=model["token_to_id"][END],
+            special_tokens=model["special_tokens"],
+            non_symbols_encoded=model["non_symbols"],
+            checkpoint=model["checkpoint"],
             beam_width=options.beam_width,
             prefix=options.prefix,
         )
         print(result)
 
 
-
 if __name__ == "__main__":
     main("./data/test/2016/UN_101_em_0.png")
@@ -92,9 +92,8 @@ def run_epoch(
             # Replace -1 with the PAD token
             expected[expected == -1] = data_loader.dataset.token_to_id[PAD]
             enc_low_res, enc_high_res = enc(input)
-            # Decoder needs to be reset, because the coverage attention (alpha)
-            # only applies to the current image.
-            dec.reset(curr_batch_size)
+            # The coverage attention (alpha) only applies to the current image.
+            alpha_low, alpha_high = dec.init_alpha(curr_batch_size)
             hidden = dec.init_hidden(curr_batch_size).to(device)
             # Starts with a START token
             sequence = torch.full(
@@ -109,7 +108,9 @@ def run_epoch(
             for i in range(batch_max_len - 1):
                 previous = expected[:, i] if use_teacher_forcing else sequence[:, -1]
                 previous = previous.view(-1, 1)
-                out, hidden = dec(previous, hidden, enc_low_res, enc_high_res)
+                out, hidden, alpha_low, alpha_high = dec(
+                    previous, hidden, enc_low_res, enc_high_res, alpha_low, alpha_high
+                )
                 hidden = hidden.detach()
                 _, top1_id = torch.topk(out, 1)
                 sequence = torch.cat((sequence, top1_id), dim=1)